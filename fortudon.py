@@ -44,11 +44,20 @@ directly to Mastodon and Pleroma instances. It incorporates a fork of
 fortune.py and includes its own Fediverse bot features.
 """
 
-import json,os,pickle,re,secrets,sys
-from mastodon import Mastodon,MastodonError
-from codecs import encode
-from argparse import ArgumentParser,RawDescriptionHelpFormatter
-from glob import glob
+import atexit,bisect,functools,json,mmap,os,pickle,random,re,stat,struct,sys,tempfile,time
+from array import array
+try:
+    from re import _parser as _sre_parse # Python 3.11 and later
+except ImportError:
+    try:
+        import sre_parse as _sre_parse
+    except ImportError: # private to re, only needed by required_literal
+        _sre_parse = None
+try:
+    import re2 # optional, regular expressions that match in linear time
+except ImportError:
+    re2 = None
+from itertools import accumulate,chain,compress,islice
 from time import sleep
 
 """
@@ -56,19 +65,47 @@ GLOBAL VARIABLES
 """
 
 FORTUDON_VERSION = "4-dev (20200407)" # Fortudon version number
-_PICKLE_PROTOCOL = 4  #  original fortune.py used 2
-INDEX_EXT = '.p4dat'  #  file extension of index files, fortune.py used '.pdat'
+INDEX_EXT = '.p5dat'  #  file extension of index files, fortune.py used '.pdat'
+                      #     and Fortudon v3 used '.p4dat'
+_INDEX_MAGIC = b'FTDX'  #  first bytes of an index file
+_INDEX_HEADER = struct.Struct('<4sII')  #  magic, flags, number of fortunes
+_INDEX_OFFENSIVE = 1  #  header flag for ROT13-rotated fortune files
 DEFAULT_LENGTH = 160  #  default number of characters a ''short'' fortune
                       #     can have at maximum
-ATTEMPTS = 10000      #  number of attempts that will be made to find an 
-                      #     appropriate fortune, before the program gives up
 ENCODING = 'utf8'     #  Encoding of the fortune files.
                       #     Should almost always be the default 'utf8'
                       #     Slackware Linux users may want to change this
                       #     to 'latin1' if they get errors (see README.md)
+_FILE_LIST_CACHE_SIZE = 32  #  number of fortune file lists kept in the cache
+_FILTER_CHUNK_SIZE = 4 * 2**20  #  bytes of a fortune file scanned by one
+                      #     worker process with -j
+_DAEMON_TIMEOUT = 0.1  #  seconds to wait for a fortune from the daemon before
+                      #     picking it in-process instead
+_ALIAS_MIN_FILES = 32  #  number of weighted fortune files from which on they
+                      #     are picked with an alias table instead of bisection
+_RANDOM = random.Random()  #  picks fortunes, seeded from os.urandom
+_SECURE_RANDOM = random.SystemRandom()  #  picks fortunes for --secure
+_TABLE_CACHE_SIZE = 256  #  number of length-filtered indexes and of tables 
+                      #     for picking fortune files kept in memory
+_INDEX_MTIMES = {}    #  modification times of the loaded index files, by path
+_FD_CACHE = {}        #  file descriptors of opened fortune files, by path
+_SEPARATOR_RE = re.compile(rb'^%\r?\n', re.M)  #  line between two fortunes
+_PERCENTAGE_RE = re.compile(r'^([0-9]{1,2})%$')  #  percentage marker in paths
+_OFFENSIVE_OPTIONS = (False, True, None, None)  #  offensive parameter, by
+                      #     the -a and -o options as (-a << 1 | -o)
+_PROG = os.path.basename(sys.argv[0])  #  name the program was invoked as
+#  paths from the FORTUNE_PATH environment variable, or None if it isn't set
+_DEFAULT_PATHS = (os.environ['FORTUNE_PATH'].split(os.pathsep)
+                  if 'FORTUNE_PATH' in os.environ else None)
+#  ROT13 translation table for offensive fortunes
+_ROT13 = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz',
+                       'NOPQRSTUVWXYZABCDEFGHIJKLMnopqrstuvwxyzabcdefghijklm')
+_ROT13_BYTES = bytes.maketrans(
+                    b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz',
+                    b'NOPQRSTUVWXYZABCDEFGHIJKLMnopqrstuvwxyzabcdefghijklm')
 
 def get_random_fortune(fortunepaths, weighted=True, offensive=None, 
-                       min_length=0, max_length=None):
+                       min_length=0, max_length=None, secure=False):
     """
     Get a random fortune from a fortune file found in the fortunepaths . 
     Barfs if the corresponding index file isn't present.
@@ -90,43 +127,48 @@ def get_random_fortune(fortunepaths, weighted=True, offensive=None,
     fortune file whose name ends in '-o'
 
     The length of the fortune that is returned will be between min_length and
-    max_length. 
+    max_length. Only fortunes within these bounds are considered when
+    picking, and so when weighing the fortune files.
+
+    If 'secure' is True, the fortune is picked with random numbers from the
+    operating system, which are suitable for cryptography, instead of with
+    the faster pseudo-random generator seeded from them.
     """
+    rng = _SECURE_RANDOM if secure else _RANDOM
     # get list of fortune files
     percentages, fortune_files = fortune_files_from_paths(fortunepaths, 
                                                           offensive)
+    # keep only the fortunes of acceptable length, and only the fortune files
+    # that still have any of those left
+    candidates = []
+    for fortune_file, percentage in zip(fortune_files, percentages):
+        data = fortune_file_data(fortune_file, min_length, max_length)
+        if data['starts']:
+            candidates.append((fortune_file, percentage, data))
+    if not candidates:
+        print("I've given up on finding a fortune that matches your criteria. They are too strict.", file=sys.stderr)
+        return ""
+    fortune_files, percentages, datas = zip(*candidates)
     # choose fortune_file
     weights = None
     if weighted:
-        weights = []
-        for fortune_file in fortune_files:
-            data = fortune_file_data(fortune_file)
-            weights.append(len(data))
-        weights = adjust_weights_with_percentages(weights, percentages)
-    attempt = 0
-    while True:
-        fortune_file = rselect_fortune_file(fortune_files, weights)
-        data = fortune_file_data(fortune_file)
-        (start, length) = secrets.choice(data)
-        if (length < min_length
-        or (max_length is not None and length > max_length)): 
-            attempt += 1
-            if attempt > ATTEMPTS:
-                print("I've given up on finding a fortune that matches your criteria. They are too strict.", file=sys.stderr)
-                return ""
-            continue
-        try:
-            ffh = open(fortune_file, 'r', encoding=str(ENCODING))
-        except OSError as err:
-            print("ERROR: ",err,file=sys.stderr)
-            sys.exit(1)
-        ffh.seek(start)
-        fortunecookie = ffh.read(length)
-        ffh.close()
-        if fortune_file.endswith('-o'):
-            return str(encode(fortunecookie,'rot13'))
-        else:
-            return str(fortunecookie)
+        weights = tuple(adjust_weights_with_percentages(
+                        [len(data['starts']) for data in datas], percentages))
+    chosen = rselect_fortune_file_index(fortune_files, weights, rng)
+    fortune_file = fortune_files[chosen]
+    data = datas[chosen]
+    i = rng.randrange(len(data['starts']))
+    try:
+        fortunecookie = os.pread(fortune_file_fd(fortune_file), 
+                                 data['sizes'][i], data['starts'][i])
+    except OSError as err:
+        print("ERROR: ",err,file=sys.stderr)
+        sys.exit(1)
+    fortunecookie = fortunecookie.decode(str(ENCODING))
+    if data['offensive']:
+        return fortunecookie.translate(_ROT13)
+    else:
+        return fortunecookie
 
 def adjust_weights_with_percentages(weights, percentages):
     """ Adjust the weights to conform to the percentages 
@@ -135,27 +177,20 @@ def adjust_weights_with_percentages(weights, percentages):
         percentage is None) are rescaled (keeping their relative magnitude
         to each other) so that the total sum of all weights stays constant
     """
-    sum_of_weights = 0
-    sum_of_free_weights = 0 # free weight: percentage is None
-    sum_of_percentages = 0
-    result = []
-    for weight, percentage in zip(weights, percentages):
-        sum_of_weights += weight
-        if percentage is None:
-            sum_of_free_weights += weight
-        else:
-            sum_of_percentages += percentage
-    for weight, percentage in zip(weights, percentages):
-        if percentage is None:
-            result.append( int(round(
-                                ( weight 
-                                  * (100 - sum_of_percentages)
-                                  * sum_of_weights)
-                                / float(100 * sum_of_free_weights) 
-                              )) )
-        else:
-            result.append(int(round((percentage * sum_of_weights) / 100.0)))
-    return result
+    sum_of_weights = sum(weights)
+    sum_of_free_weights = sum(weight for weight, percentage 
+                              in zip(weights, percentages)
+                              if percentage is None) # free weight: no percentage
+    sum_of_percentages = sum(percentage for percentage in percentages 
+                             if percentage is not None)
+    free_scale = 0.0
+    if sum_of_free_weights:
+        free_scale = ((100 - sum_of_percentages) * sum_of_weights 
+                      / float(100 * sum_of_free_weights))
+    percentage_scale = sum_of_weights / 100.0
+    return [int(round(weight * free_scale)) if percentage is None else
+            int(round(percentage * percentage_scale))
+            for weight, percentage in zip(weights, percentages)]
 
 def fortune_files_from_paths(fortunepaths, offensive=None):
     """ Return (percentages, fortune_files)
@@ -181,38 +216,87 @@ def fortune_files_from_paths(fortunepaths, offensive=None):
         files. If 'offensive' is True, include only offensive fortune files, 
         if it is False, include only non-offensive fortune files.
         An offensive fortune fortune files is defined as who's name ends in '-o'
+
+        The result is cached on disk (see file_list_cache_path), and reused
+        for as long as none of the directories in fortunepaths changes.
+    """
+    directories = fortune_path_directories(fortunepaths)
+    key = file_list_cache_key(fortunepaths, offensive, directories)
+    if key is None:
+        return _scan_fortune_paths(fortunepaths, offensive, directories)
+    cache = read_file_list_cache()
+    if key in cache:
+        percentages, fortune_files = cache[key]
+        return (list(percentages), list(fortune_files))
+    percentages, fortune_files = _scan_fortune_paths(fortunepaths, offensive,
+                                                     directories)
+    cache[key] = (percentages, fortune_files)
+    while len(cache) > _FILE_LIST_CACHE_SIZE:
+        del cache[next(iter(cache))] # drop the oldest entry
+    write_file_list_cache(cache)
+    return (percentages, fortune_files)
+
+def fortune_path_directories(fortunepaths):
+    """ Return a dictionary mapping each path in fortunepaths which is a 
+        directory to its modification time (in nanoseconds)
+
+        Every path is looked at only once, here; all other paths are taken
+        to be either percentage markers or fortune files, and are used as 
+        they are.
+    """
+    directories = {}
+    for path in fortunepaths:
+        if path in directories or _PERCENTAGE_RE.match(path):
+            continue
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISDIR(path_stat.st_mode):
+            directories[path] = path_stat.st_mtime_ns
+    return directories
+
+def _scan_fortune_paths(fortunepaths, offensive=None, directories=None):
+    """ Return (percentages, fortune_files) for fortunepaths, without 
+        using the cache. See fortune_files_from_paths.
+
+        directories is the result of fortune_path_directories(fortunepaths)
     """
-    percentage_pattern = re.compile('([0-9]{1,2})%')
+    if directories is None:
+        directories = fortune_path_directories(fortunepaths)
     fortune_files = []
     percentages = []
     percentage = None
     for path in fortunepaths:
-        percentage_match = percentage_pattern.match(path)
+        percentage_match = _PERCENTAGE_RE.match(path)
         if percentage_match:
             percentage = percentage_match.group(1) 
             continue
         else:
-            if os.path.isdir(path):
-                files_in_path = [filename[:-len(INDEX_EXT)] for filename 
-                                in glob(os.path.join(path, "*"+INDEX_EXT))]
+            if path in directories:
+                with os.scandir(path) as entries:
+                    files_in_path = [entry.path[:-len(INDEX_EXT)] 
+                                     for entry in entries
+                                     if entry.name.endswith(INDEX_EXT)
+                                     and not entry.name.startswith('.')
+                                     and entry.is_file()]
                 if offensive is not None:
                     files_in_path = [fortune_file for fortune_file 
                                      in files_in_path
-                                     if not xor(fortune_file.endswith('-o'),
-                                                offensive)]
+                                     if fortune_file.endswith('-o') 
+                                        == offensive]
 
-                fortune_files += files_in_path
-                number_of_added_files = float(len(fortune_files) 
-                                              - len(percentages))
-                while len(percentages) < len(fortune_files):
-                    if percentage is not None:
-                        percentages.append(int(percentage) 
-                                           / number_of_added_files)
-                    else:
-                        percentages.append(None)
+                number_of_added_files = len(files_in_path)
+                fortune_files.extend(files_in_path)
+                if percentage is not None and number_of_added_files:
+                    percentages.extend([int(percentage) 
+                                        / float(number_of_added_files)]
+                                       * number_of_added_files)
+                else:
+                    percentages.extend([None] * number_of_added_files)
             else:
                 if offensive is not None:
-                    if xor(path.endswith('-o'), offensive):
+                    if path.endswith('-o') != offensive:
                         path = None
                 if path is not None: 
                     fortune_files.append(path) # path is file
@@ -223,6 +307,70 @@ def fortune_files_from_paths(fortunepaths, offensive=None):
             percentage = None
     return (check_percentages(percentages), fortune_files)
 
+def file_list_cache_path():
+    """ Return the path of the file in which fortune_files_from_paths caches
+        its results, in $XDG_CACHE_HOME (by default ~/.cache)
+    """
+    cache_home = (os.environ.get('XDG_CACHE_HOME') 
+                  or os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'fortudon', 'filelists.pickle')
+
+def file_list_cache_key(fortunepaths, offensive=None, directories=None):
+    """ Return the key for the result of fortune_files_from_paths in the
+        file list cache, or None if the result shouldn't be cached
+
+        directories is the result of fortune_path_directories(fortunepaths)
+
+        The key contains the modification time of every directory in 
+        fortunepaths, which changes whenever index files are added to or
+        removed from it. Directories modified in the last two seconds 
+        make the result uncacheable, as a second change within the 
+        resolution of the timestamps could go unnoticed.
+    """
+    if directories is None:
+        directories = fortune_path_directories(fortunepaths)
+    recent = int((time.time() - 2) * 10**9)
+    if any(mtime > recent for mtime in directories.values()):
+        return None
+    key = [INDEX_EXT, offensive]
+    for path in fortunepaths:
+        if path in directories:
+            key.append((path, os.path.abspath(path), directories[path]))
+        else:
+            key.append((path, None))
+    return tuple(key)
+
+def read_file_list_cache():
+    """ Return the file list cache as a dictionary, which is empty if there
+        is no usable cache file
+    """
+    try:
+        with open(file_list_cache_path(), 'rb', buffering=0) as cache_file:
+            cache = pickle.loads(cache_file.read())
+    except Exception: # missing, damaged, or written by a newer Python
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return cache
+
+def write_file_list_cache(cache):
+    """ Replace the file list cache with the dictionary cache. Failing to
+        write it is not an error, the cache just won't be used.
+    """
+    cache_path = file_list_cache_path()
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                pickle.dump(cache, cache_file, 4) # readable from Python 3.4
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except OSError:
+        pass
+
 def check_percentages(percentages):
     """ Check percentages for validity
         
@@ -270,7 +418,7 @@ def check_percentages(percentages):
     return percentages
 
 def filter_fortunes(fortunepaths, pattern, ignorecase=True, offensive=None,
-                    min_length=0, max_length=None):
+                    min_length=0, max_length=None, jobs=1):
     """ Print out all fortunes which match the regular expression pattern. 
 
         If ignorecase is True, the pattern is taken as case-insensitive.
@@ -284,151 +432,529 @@ def filter_fortunes(fortunepaths, pattern, ignorecase=True, offensive=None,
 
         In addition to the pattern, the selected fortunes are constrained by
         the offensive, min_length, and max_length parameters.
+
+        Only the fortunes containing the literal text that every match of
+        the pattern needs (see required_literal) are decoded and matched
+        against the pattern. Matching fortunes are written out as they are
+        encoded in the fortune files.
+
+        If jobs is greater than 1, the fortune files are scanned by that many
+        worker processes, with large files split into pieces (see 
+        fortune_file_ranges); the output is the same, and in the same order.
     """
-    regex_filter = re.compile(pattern)
-    if ignorecase:
-        regex_filter = re.compile(pattern, re.I)
+    regex_filter, literal = _compiled_filter(pattern, ignorecase)
     percentages, fortune_files = fortune_files_from_paths(fortunepaths, 
                                                           offensive)
-
-    # "first" fortune file (or up to wherever the first match is)
-    # The reason for having to handle the first match separately is to get
-    # the formatting of the output right.
+    # results yields a list of matches for each of the ranges of each file
+    ranges = [[(0, None)]] * len(fortune_files)
+    executor = None
+    if jobs > 1:
+        ranges = [fortune_file_ranges(fortune_file) 
+                  for fortune_file in fortune_files]
+    if sum(map(len, ranges)) > 1 and jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(_scan_one_file,
+                               [(fortune_file, pattern, ignorecase,
+                                 min_length, max_length, start, end)
+                                for fortune_file, file_ranges 
+                                in zip(fortune_files, ranges)
+                                for start, end in file_ranges],
+                               chunksize=4)
+    else:
+        results = (matching_fortunes(fortune_file, regex_filter, 
+                                     min_length, max_length,
+                                     literal, ignorecase)
+                   for fortune_file in fortune_files)
+    # The first match is printed differently from the others, to get the
+    # formatting of the output right. Matches are written to stdout in one
+    # go per fortune file, which is flushed before the name of the next
+    # file goes to stderr, so that both stay in order if redirected together.
+    sys.stdout.flush()
     found_first_match = False
-    while not found_first_match:
+    try:
+        for fortune_file, file_ranges in zip(fortune_files, ranges):
+            if found_first_match:
+                print("%\n(" + os.path.split(fortune_file)[1] + ')', 
+                      file=sys.stderr)
+            else:
+                print('(' + os.path.split(fortune_file)[1] + ")\n%",
+                      file=sys.stderr)
+            sys.stderr.flush()
+            output = []
+            for fortune in chain.from_iterable(islice(results, 
+                                                      len(file_ranges))):
+                if found_first_match:
+                    output += [b"%\n", fortune]
+                else:
+                    output += [fortune, b"\n"]
+                    found_first_match = True
+            sys.stdout.buffer.write(b"".join(output))
+            sys.stdout.buffer.flush()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if not found_first_match:
+        print("Nothing found!",file=sys.stderr)
+        sys.exit(1)
+    return 0
+
+def _scan_one_file(job):
+    """ Return the matching fortunes for one range of a fortune file, in a 
+        worker process.
+
+        job is a tuple of fortune_file, pattern, ignorecase, min_length and
+        max_length, as passed to filter_fortunes, and of the start and end
+        of the range, as returned by fortune_file_ranges.
+    """
+    (fortune_file, pattern, ignorecase, min_length, max_length, 
+     start, end) = job
+    regex_filter, literal = _compiled_filter(pattern, ignorecase)
+    return matching_fortunes(fortune_file, regex_filter, min_length, 
+                             max_length, literal, ignorecase, start, end)
+
+@functools.lru_cache(maxsize=None)
+def _compiled_filter(pattern, ignorecase):
+    """ Return the compiled filter for pattern, and the literal required by
+        it encoded with ENCODING, as used by matching_fortunes. The result is
+        cached, so that each worker process of filter_fortunes compiles the
+        pattern only once.
+    """
+    literal = required_literal(pattern)
+    if literal is not None and ignorecase:
+        # The literal is searched for ignoring ASCII case only, so it is
+        # cut down to ASCII characters, without i, k and s, which re also
+        # matches to non-ASCII letters (like the Kelvin sign) ignoring case.
+        literal = max(re.split(r'[^\x00-\x7f]|[iksIKS]', literal), 
+                      key=len) or None
+    if literal is not None:
         try:
-            fortune_file = fortune_files.pop(0)
-        except IndexError:
-            print("Nothing found!",file=sys.stderr)
-            sys.exit(1)
-        print('(' + os.path.split(fortune_file)[1] + ")\n%",file=sys.stderr)
-        sys.stderr.flush()
+            literal = literal.encode(str(ENCODING))
+        except UnicodeEncodeError:
+            literal = None
+    return (compile_filter(pattern, ignorecase), literal)
+
+def compile_filter(pattern, ignorecase=True):
+    """ Return the regular expression pattern compiled for matching against
+        decoded fortunes
+
+        If the re2 module is installed, it is used instead of re, as it 
+        can't be made to backtrack catastrophically. Patterns re2 doesn't
+        support (like backreferences), which contain non-ASCII characters,
+        or whose meaning differs between re2 and re (like '$', which re
+        also matches before a final newline, and '\\w', which re2 limits
+        to ASCII), are compiled with re.
+    """
+    if (re2 is not None and all(ord(char) < 128 for char in pattern)
+            and '$' not in pattern 
+            and not re.search(r'\\[0-9A-Za-z]', pattern)):
+        re2_args = ()
+        if hasattr(re2, 'Options'): # google-re2, keep it from logging errors
+            re2_args = (re2.Options(),)
+            re2_args[0].log_errors = False
         try:
-            fortunes = read_fortunes(open(fortune_file, 'r', encoding=str(ENCODING)))
-        except OSError as err:
-            print("ERROR: ",err,file=sys.stderr)
-            sys.exit(1)
-        while not found_first_match:
-            try:
-                start, length, fortune = next(fortunes)
+            return re2.compile(('(?i)' if ignorecase else '') + pattern,
+                               *re2_args)
+        except re2.error:
+            pass
+    return re.compile(pattern, re.I if ignorecase else 0)
+
+def required_literal(pattern):
+    """ Return the longest run of literal characters that every match of 
+        the regular expression pattern must contain, as the same type as
+        pattern (str or bytes), or None if there is none, or the pattern
+        is too involved to tell
+
+        This is used to skip fortunes, and whole fortune files, that can't 
+        match, with a plain substring search instead of the regex. The
+        pattern is taken apart by the parser of the re module, so that
+        escapes are read exactly as when the pattern is compiled.
+    """
+    # The literal is only an optimisation, so anything going wrong with 
+    # the private parser, which may be missing or changed in later Python
+    # versions, just returns None and turns the prefilter off.
+    try:
+        parsed = _sre_parse.parse(pattern)
+        state = parsed.state if hasattr(parsed, 'state') else parsed.pattern
+        if state.flags & re.IGNORECASE: # inline (?i)
+            return None
+        longest = []
+        run = []
+        for op, argument in list(parsed) + [(None, None)]:
+            if op == _sre_parse.LITERAL:
+                run.append(argument)
+                continue
+            if len(run) > len(longest):
+                longest = run
+            run = []
+    except Exception: # also for invalid patterns, compile_filter reports them
+        return None
+    if not longest:
+        return None
+    if isinstance(pattern, bytes):
+        return bytes(longest)
+    return "".join(map(chr, longest))
+
+def buffer_contains(text, literal, ignorecase=False, start=0, end=None):
+    """ Return whether the buffer text (bytes or a memory-mapped file)
+        contains the bytes literal between start and end (if not None), 
+        ignoring ASCII case if ignorecase is True
+    """
+    if end is None:
+        end = len(text)
+    if ignorecase:
+        return re.compile(re.escape(literal), re.I).search(
+                    text, start, end) is not None
+    return text.find(literal, start, end) >= 0
+
+def matching_fortunes(fortune_file, regex_filter, min_length=0, 
+                      max_length=None, literal=None, ignorecase=False,
+                      start=0, end=None):
+    """ Return a list of the fortunes in fortune_file which match the 
+        compiled pattern regex_filter, and whose length is between 
+        min_length and max_length (if not None). The fortunes are returned 
+        as bytes, in the encoding of the fortune file, but ROT13-rotated
+        back if the fortune file is offensive.
+
+        If literal is given, it must be the literal returned with
+        regex_filter by _compiled_filter, and ignorecase must be the
+        case-sensitivity it was compiled with. Files and fortunes not
+        containing literal are then skipped without decoding them.
+
+        If start and end are given, only the fortunes between these bytes 
+        of the file are looked at, see fortune_file_ranges.
+    """
+    is_offensive = fortune_file.endswith('-o')
+    check_length = min_length > 0 or max_length is not None
+    if literal is not None and ignorecase:
+        literal = literal.lower()
+    result = []
+    try:
+        with open(fortune_file, 'rb', buffering=0) as fortune_fh:
+            # no fortune has more characters than the file has bytes
+            if os.fstat(fortune_fh.fileno()).st_size < max(min_length, 1):
+                return result
+            text = mmap.mmap(fortune_fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError as err:
+        print("ERROR: ",err,file=sys.stderr)
+        sys.exit(1)
+    with text:
+        if literal is not None and not buffer_contains(text, 
+                literal.translate(_ROT13_BYTES) if is_offensive else literal,
+                ignorecase, start, end):
+            return result
+        for pos, size, fortune in split_fortunes(text, start, end):
+            if is_offensive:
+                fortune = fortune.translate(_ROT13_BYTES)
+            if literal is not None and literal not in (
+                    fortune.lower() if ignorecase else fortune):
+                continue
+            decoded = fortune.decode(str(ENCODING))
+            if not regex_filter.search(decoded):
+                continue
+            if check_length:
+                length = len(decoded)
                 if (length < min_length 
                 or (max_length is not None and length > max_length)):
                     continue
-                
-                if fortune_file.endswith('-o'):
-                    rotfortune = encode(fortune,'rot13')
-                else:
-                    rotfortune = fortune
-
-                if regex_filter.search(rotfortune):
-                    print(rotfortune)
-                    found_first_match = True
-            except StopIteration:
-                break
-    for start, length, fortune in fortunes: # remaining fortunes of "first" file
-        if (length < min_length 
-        or (max_length is not None and length > max_length)):
-            continue
-        if regex_filter.search(fortune):
-            print("%")
-            sys.stdout.write(fortune)
-    sys.stdout.flush()
+            result.append(fortune)
+    return result
 
-    # remaining fortune files
-    for fortune_file in fortune_files: # original "first" item(s) were popped!
-        print("%\n(" + os.path.split(fortune_file)[1] + ')', file=sys.stderr)
-        sys.stderr.flush()
-        try:
-            fortunes = read_fortunes(open(fortune_file, 'r', encoding=str(ENCODING)))
-        except OSError as err:
-            print("ERROR: ",err,file=sys.stderr)
-            sys.exit(1)
-        for start, length, fortune in fortunes: # starting a second!
-            if (length < min_length 
-            or (max_length is not None and length > max_length)):
-                continue
-            if fortune_file.endswith('-o'):
-                rotfortune = encode(fortune,'rot13')
-            else:
-                rotfortune = fortune
-            if regex_filter.search(rotfortune):
-                print('%')
-                sys.stdout.write(rotfortune)
-        sys.stdout.flush()
-    return 0
+def fortune_file_data(fortune_file, min_length=0, max_length=None):
+    """ Return the index for fortune_file
 
-def xor(bool_a, bool_b):
-    """ Logical XOR between boolean variables bool_a and bool_b """
-    return ((bool_a and not bool_b) or (bool_b and not bool_a))
+        The index is a dictionary of parallel arrays, 'starts', 'sizes' and
+        'lengths', holding the start byte, the size in bytes and the length
+        in characters of each fortune, and of the flag 'offensive', which 
+        tells whether the fortune file is ROT13-rotated. Only
+        the entries for fortunes whose length is between min_length and
+        max_length are returned.
 
-def fortune_file_data(fortune_file):
-    """ Return the pickled index for fortune_file """
+        The index is loaded once per process and cached; it is reloaded if
+        the index file has been modified since it was last read, and the
+        cached indexes are then dropped, so that a long-running process
+        doesn't keep every version of them.
+    """
     fortune_index_file = str(fortune_file) + INDEX_EXT
-    if not os.path.exists(fortune_index_file):
+    try:
+        mtime = os.stat(fortune_index_file).st_mtime_ns
+    except FileNotFoundError:
         raise ValueError('Can\'t find file "%s"' % fortune_index_file)
+    except OSError as err:
+        print("ERROR: ",err,file=sys.stderr)
+        sys.exit(1)
+    if _INDEX_MTIMES.setdefault(fortune_index_file, mtime) != mtime:
+        # drop the indexes loaded before, rather than keeping the old one
+        _INDEX_MTIMES[fortune_index_file] = mtime
+        _load_fortune_index.cache_clear()
+        _fortune_index_in_range.cache_clear()
+        _length_range.cache_clear()
+    return _fortune_index_in_range(fortune_index_file, mtime, 
+                                   min_length, max_length)
+
+@functools.lru_cache(maxsize=None)
+def _load_fortune_index(fortune_index_file, mtime):
+    """ Return the contents of fortune_index_file. mtime is only used as 
+        part of the cache key.
+    """
     try:
-        fortune_index = open(fortune_index_file, 'rb')
+        # read whole rather than mapped, as a mapping would keep a file
+        # descriptor open for every cached index
+        with open(fortune_index_file, 'rb', buffering=0) as fortune_index:
+            raw = fortune_index.read()
     except OSError as err:
         print("ERROR: ",err,file=sys.stderr)
         sys.exit(1)
-    data = pickle.load(fortune_index)
-    fortune_index.close()
+    if raw[:len(_INDEX_MAGIC)] != _INDEX_MAGIC: # pickled by earlier versions, or empty
+        raise ValueError('Index file "%s" is out of date, update it with -u' 
+                         % fortune_index_file)
+    data = unpack_fortune_index(raw)
+    if data is None:
+        raise ValueError('Index file "%s" is damaged, update it with -u' 
+                         % fortune_index_file)
+    # the fortune file may have changed along with its index
+    close_fortune_file_fd(fortune_index_file[:-len(INDEX_EXT)])
+    return data
+
+@functools.lru_cache(maxsize=_TABLE_CACHE_SIZE)
+def _fortune_index_in_range(fortune_index_file, mtime, min_length, max_length):
+    """ Return the index of fortune_index_file, restricted to fortunes
+        whose length is between min_length and max_length (if not None)
+    """
+    data = _load_fortune_index(fortune_index_file, mtime)
+    if max_length is None:
+        max_length = sys.maxsize
+    if not data['lengths']:
+        return data
+    shortest, longest = _length_range(fortune_index_file, mtime)
+    if min_length <= shortest and longest <= max_length: # all in range
+        return data
+    if longest < min_length or max_length < shortest: # none in range
+        in_range = ()
+    else:
+        in_range = [min_length <= length <= max_length 
+                    for length in data['lengths']]
+    return {'starts': array('q', compress(data['starts'], in_range)),
+            'sizes': array('i', compress(data['sizes'], in_range)),
+            'lengths': array('i', compress(data['lengths'], in_range)),
+            'offensive': data['offensive']}
+
+@functools.lru_cache(maxsize=None)
+def _length_range(fortune_index_file, mtime):
+    """ Return the lengths of the shortest and the longest fortune in the
+        (non-empty) index of fortune_index_file
+    """
+    lengths = _load_fortune_index(fortune_index_file, mtime)['lengths']
+    return (min(lengths), max(lengths))
+
+def pack_fortune_index(data):
+    """ Return the index data (as returned by fortune_file_data) in the
+        binary format of index files
+
+        The format is a header (see _INDEX_HEADER) followed by the 'starts'
+        column as little-endian 64 bit integers, and the 'sizes' and 
+        'lengths' columns as little-endian 32 bit integers.
+    """
+    flags = _INDEX_OFFENSIVE if data['offensive'] else 0
+    chunks = [_INDEX_HEADER.pack(_INDEX_MAGIC, flags, len(data['starts']))]
+    for key, typecode in (('starts', 'q'), ('sizes', 'i'), ('lengths', 'i')):
+        column = array(typecode, data[key])
+        if sys.byteorder != 'little':
+            column.byteswap()
+        chunks.append(column.tobytes())
+    return b"".join(chunks)
+
+def unpack_fortune_index(raw):
+    """ Return the index data stored in the bytes raw, which are in the
+        format written by pack_fortune_index, or None if raw is malformed
+
+        On little-endian machines the columns are memoryviews of raw, so
+        they aren't copied.
+    """
+    if len(raw) < _INDEX_HEADER.size:
+        return None
+    magic, flags, number = _INDEX_HEADER.unpack_from(raw)
+    if len(raw) != _INDEX_HEADER.size + number * 16:
+        return None
+    data = {'offensive': bool(flags & _INDEX_OFFENSIVE)}
+    pos = _INDEX_HEADER.size
+    for key, typecode in (('starts', 'q'), ('sizes', 'i'), ('lengths', 'i')):
+        end = pos + number * array(typecode).itemsize
+        if sys.byteorder == 'little':
+            column = memoryview(raw)[pos:end].cast(typecode)
+        else:
+            column = array(typecode, raw[pos:end])
+            column.byteswap()
+        data[key] = column
+        pos = end
     return data
 
-def rselect_fortune_file(fortune_files, weights=None):
-    """ Return a random element from fortune_files
+def fortune_file_fd(fortune_file):
+    """ Return a read-only file descriptor for fortune_file
+
+        The file is opened once per process; the descriptor is cached and
+        closed when the program exits.
+    """
+    try:
+        return _FD_CACHE[fortune_file]
+    except KeyError:
+        fd = _FD_CACHE[fortune_file] = os.open(fortune_file, os.O_RDONLY)
+        return fd
+
+def close_fortune_file_fd(fortune_file=None):
+    """ Close the cached file descriptor for fortune_file, or all of them 
+        if fortune_file is None
+    """
+    if fortune_file is None:
+        fortune_files = list(_FD_CACHE)
+    else:
+        fortune_files = [fortune_file]
+    for fortune_file in fortune_files:
+        fd = _FD_CACHE.pop(fortune_file, None)
+        if fd is not None:
+            os.close(fd)
+
+atexit.register(close_fortune_file_fd)
+
+def rselect_fortune_file_index(fortune_files, weights=None, rng=_RANDOM):
+    """ Return the index of a random element from fortune_files
 
         If weights is not given, all elements of fortune_files are equally
-        likely to be returned.
-        If weights is given, it must be an array of the same length as 
+        likely to be chosen.
+        If weights is given, it must be a tuple of the same length as 
         fortune_files, consisting of integers. The ratio of the integer at 
         a position to the sum of all integers is the probability that the
-        element at the same position in fortune_files is returned.
+        element at the same position in fortune_files is chosen.
+        The random numbers come from rng, a random.Random instance.
     """
     if weights is None:
-        return secrets.choice(fortune_files)
-    # find sum of weights
-    total = 0
-    for weight in weights:
-        total += weight
-    # choose randomly
-    rand_limit = secrets.randbelow(total) + 1
-    total = 0
-    i = 0
-    for weight in weights:
-        total += weight
-        if total >= rand_limit:
-            return fortune_files[i]
-        i += 1
-    raise (Exception, "Couldn't select a fortune file")
-
-def read_fortunes(fortune_file):
-    """ Return iterator yielding tuples (start, length, fortune)
-        where start is the byte nr in the fortune file where the
-        fortune starts, length is the number of bytes of the fortune,
-        and fortune is the text of the fortune as a string.
-    """
-    fortune_lines = []
-    start = -1
-    pos = 0
-    for line in fortune_file:
-        if line == "%\n":
-            if pos == 0: # "%" at top of file. Skip it.
-                continue
-            fortune = "".join(fortune_lines)
-            if fortune != "": 
-                yield (start , len(fortune), fortune)
-            fortune_lines = []
-            start = -1
+        return rng.randrange(len(fortune_files))
+    if len(weights) < _ALIAS_MIN_FILES:
+        cum_weights = cumulative_weights(weights)
+        rand_limit = rng.randrange(cum_weights[-1]) + 1
+        return bisect.bisect_left(cum_weights, rand_limit)
+    total, prob, alias = alias_table(weights)
+    i = rng.randrange(len(weights))
+    if rng.randrange(total) < prob[i]:
+        return i
+    return alias[i]
+
+@functools.lru_cache(maxsize=_TABLE_CACHE_SIZE)
+def cumulative_weights(weights):
+    """ Return the cumulative sums of the tuple of integer weights, for 
+        picking from them by bisection, as a compact_array. The result is
+        cached.
+    """
+    return compact_array(accumulate(weights))
+
+@functools.lru_cache(maxsize=_TABLE_CACHE_SIZE)
+def alias_table(weights):
+    """ Return (total, prob, alias), the alias table for Walker's alias 
+        method for the tuple of integer weights
+
+        To draw from it, pick a position i uniformly, then keep i with 
+        probability prob[i] / total, or take alias[i] otherwise. The table
+        is built with integer arithmetic (Vose's method), so it is exact.
+        It is cached, so that repeated draws with the same weights are O(1).
+        prob and alias are compact_arrays.
+    """
+    number = len(weights)
+    total = sum(weights)
+    scaled = [weight * number for weight in weights] # each bucket holds total
+    prob = [total] * number
+    alias = list(range(number))
+    small = [i for i, weight in enumerate(scaled) if weight < total]
+    large = [i for i, weight in enumerate(scaled) if weight >= total]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        prob[less] = scaled[less]
+        alias[less] = more
+        scaled[more] -= total - scaled[less]
+        if scaled[more] < total:
+            small.append(more)
         else:
-            if start == -1:
-                start = pos
-            fortune_lines.append(line)
-        pos += len(line.encode(str(ENCODING)))
+            large.append(more)
+    return (total, compact_array(prob), compact_array(alias))
+
+def compact_array(values):
+    """ Return the non-negative integers values as an array of the smallest
+        unsigned type that holds all of them, or as a tuple if none does
+
+        The tables for picking fortune files are kept this way, so that they
+        take a few bytes per file instead of a pointer to an int object.
+    """
+    values = list(values)
+    largest = max(values, default=0)
+    for typecode in 'BHILQ':
+        if largest >> (8 * array(typecode).itemsize) == 0:
+            return array(typecode, values)
+    return tuple(values)
+
+def split_fortunes(text, pos=0, endpos=None):
+    """ Return iterator yielding tuples (start, size, fortune)
+        for the fortunes in the buffer text (bytes or a memory-mapped 
+        fortune file), where start is the byte nr in text where the
+        fortune starts, size is the number of bytes of the fortune,
+        and fortune is the text of the fortune as (undecoded) bytes.
 
-    fortune = "".join(fortune_lines)
-    if fortune != "": 
-        yield (start, pos - start, fortune)
+        If pos and endpos are given, only the fortunes between these bytes
+        of text are returned; pos must be at the start of a line.
+
+        The separator lines are found by C-level searching, without 
+        looking at each line of text in Python.
+    """
+    if endpos is None:
+        endpos = len(text)
+    start = pos
+    for separator in _SEPARATOR_RE.finditer(text, pos, endpos):
+        end = separator.start()
+        if end > start:
+            yield (start, end - start, text[start:end])
+        start = separator.end()
+    if endpos > start:
+        yield (start, endpos - start, text[start:endpos])
+
+def fortune_file_ranges(fortune_file, chunk_size=_FILTER_CHUNK_SIZE):
+    """ Return a list of tuples (start, end) of byte ranges that together
+        cover the fortune file at the path fortune_file, each of about
+        chunk_size bytes. The ranges are split at separator lines, so that
+        split_fortunes finds the same fortunes in them as in the whole file.
+        end is None for the last range.
+    """
+    try:
+        with open(fortune_file, 'rb', buffering=0) as fortune_fh:
+            size = os.fstat(fortune_fh.fileno()).st_size
+            if size <= chunk_size:
+                return [(0, None)]
+            with mmap.mmap(fortune_fh.fileno(), 0, 
+                           access=mmap.ACCESS_READ) as text:
+                bounds = [0]
+                while True:
+                    separator = _SEPARATOR_RE.search(text, 
+                                                     bounds[-1] + chunk_size)
+                    if separator is None:
+                        break
+                    bounds.append(separator.start())
+    except OSError as err:
+        print("ERROR: ",err,file=sys.stderr)
+        sys.exit(1)
+    return list(zip(bounds, bounds[1:] + [None]))
+
+def read_fortunes_bulk(fortune_file):
+    """ Return iterator yielding tuples (start, size, fortune), like
+        split_fortunes, for the fortune file at the path fortune_file.
+
+        The whole file is memory-mapped and split on the separator lines,
+        which is much faster than reading it line by line, and doesn't 
+        copy the file into memory.
+    """
+    with open(fortune_file, 'rb', buffering=0) as fortune_fh:
+        if os.fstat(fortune_fh.fileno()).st_size == 0:
+            return
+        with mmap.mmap(fortune_fh.fileno(), 0, 
+                       access=mmap.ACCESS_READ) as text:
+            yield from split_fortunes(text)
 
 def make_fortune_data_file(fortunepaths, quiet=False):
     """
@@ -437,12 +963,16 @@ def make_fortune_data_file(fortunepaths, quiet=False):
     fortune_files = []
     for path in fortunepaths:
         if os.path.isdir(path):
-            fortune_files += [filename for filename 
-                            in glob(os.path.join(path, "*"))
-                            if not filename.endswith(INDEX_EXT)
-                            ]
+            with os.scandir(path) as entries:
+                fortune_files += [entry.path for entry in entries
+                                  if not entry.name.endswith((INDEX_EXT, 
+                                                              '.p4dat'))
+                                  and not entry.name.startswith('.')
+                                  and entry.is_file()]
         else:
             fortune_files.append(path) # path is a file
+    umask = os.umask(0o022) # the umask can only be read by setting it
+    os.umask(umask)
     for fortune_file in fortune_files:
 
         fortune_index_file = fortune_file + INDEX_EXT
@@ -450,31 +980,153 @@ def make_fortune_data_file(fortunepaths, quiet=False):
             print('Updating "%s" from "%s"...' \
                                             % (fortune_index_file, fortune_file))
 
-        data = []
+        starts = array('q')
+        sizes = array('i')
+        lengths = array('i')
         shortest = sys.maxsize
         longest = 0
         try:
-            for start, length, fortune in read_fortunes(open(fortune_file, 'r', encoding=str(ENCODING))):
-                data += [(start, length)]
-                #print ("Wrote: " + str(start), str(length))
-                #print
+            for start, size, fortune in read_fortunes_bulk(fortune_file):
+                length = len(fortune.decode(str(ENCODING)))
+                starts.append(start)
+                sizes.append(size)
+                lengths.append(length)
                 shortest = min(shortest, length)
                 longest = max(longest, length)
         except OSError as err:
                 print("ERROR: ",err,file=sys.stderr)
                 sys.exit(1)
 
+        # The index is written to a temporary file which then replaces it,
+        # as processes that have the old index mapped in memory would crash
+        # if it was truncated under them.
         try:
-            fortune_index = open(fortune_index_file, 'wb')
+            fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(fortune_index_file) or os.curdir,
+                prefix='.' + os.path.basename(fortune_index_file), 
+                suffix='.tmp')
+            try:
+                # mkstemp makes the file private, index files are not
+                os.chmod(temp_path, 0o666 & ~umask)
+                with os.fdopen(fd, 'wb') as fortune_index:
+                    fortune_index.write(pack_fortune_index(
+                                {'starts': starts, 'sizes': sizes, 
+                                 'lengths': lengths,
+                                 'offensive': fortune_file.endswith('-o')}))
+                os.replace(temp_path, fortune_index_file)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
         except OSError as err:
             print("ERROR: ",err,file=sys.stderr)
             sys.exit(1)
-        pickle.dump(data, fortune_index, _PICKLE_PROTOCOL)
-        fortune_index.close()
 
         if not quiet:
             print('Processed %d fortunes.\nLongest: %d\nShortest %d' % \
-                (len(data), longest, shortest))
+                (len(starts), longest, shortest))
+
+def daemon_socket_path():
+    """ Return the path of the Unix socket on which the daemon started with
+        --daemon serves fortunes, in $XDG_RUNTIME_DIR, or None if 
+        $XDG_RUNTIME_DIR isn't set
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        return None
+    return os.path.join(runtime_dir, 'fortudon.sock')
+
+def serve_fortunes(socket_path):
+    """ Serve random fortunes on the Unix socket socket_path until 
+        interrupted or terminated.
+
+        Each request is the JSON-encoded keyword arguments of 
+        get_random_fortune, sent by fortune_from_daemon. Since the process
+        keeps running, the fortune indexes and the tables for picking 
+        fortune files stay loaded between requests.
+    """
+    import signal,socket
+    # stop on SIGTERM as on SIGINT, removing the socket
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        os.unlink(socket_path) # left behind by a daemon that was killed
+    except FileNotFoundError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_path)
+        server.listen(16)
+        while True:
+            connection = server.accept()[0]
+            with connection:
+                connection.settimeout(1)
+                try:
+                    request = b"".join(iter(
+                        functools.partial(connection.recv, 65536), b""))
+                    connection.sendall(_daemon_reply(request))
+                except OSError:
+                    pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
+
+def _daemon_reply(request):
+    """ Return the reply of the daemon to request: '+' and the fortune, or
+        '-' and the message of the ValueError raised while picking it, in
+        UTF-8. The reply is empty if no fortune was picked for another 
+        reason, so that the client tries for itself and reports why.
+    """
+    try:
+        options = json.loads(request.decode('utf-8'))
+        fortune = get_random_fortune(**options)
+    except ValueError as msg:
+        return b'-' + str(msg).encode('utf-8')
+    except SystemExit: # the error is printed on stderr
+        return b""
+    except Exception as err: # keep serving other requests
+        print("ERROR: ",repr(err),file=sys.stderr)
+        return b""
+    if not fortune: # nothing matched, which is reported on stderr
+        return b""
+    return b'+' + fortune.encode('utf-8')
+
+def fortune_from_daemon(fortunepaths, **options):
+    """ Return a random fortune from the daemon started with --daemon, or 
+        None if it isn't running or doesn't reply in time.
+
+        The arguments are the same as for get_random_fortune, which is
+        called by the daemon; like it, this raises ValueError if no fortune
+        can be picked from fortunepaths.
+    """
+    socket_path = daemon_socket_path()
+    if socket_path is None or not os.path.exists(socket_path):
+        return None
+    import socket
+    # the daemon runs in another working directory; empty paths and
+    # percentages are passed on as they are, as abspath('') is the cwd
+    options['fortunepaths'] = [
+        os.path.abspath(path) if path and not _PERCENTAGE_RE.match(path) 
+        else path for path in fortunepaths]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(_DAEMON_TIMEOUT)
+            client.connect(socket_path)
+            client.sendall(json.dumps(options).encode('utf-8'))
+            client.shutdown(socket.SHUT_WR)
+            reply = b"".join(iter(functools.partial(client.recv, 65536), 
+                                  b""))
+    except OSError:
+        return None
+    reply = reply.decode('utf-8')
+    if reply.startswith('+'):
+        return reply[1:]
+    if reply.startswith('-'):
+        raise ValueError(reply[1:])
+    return None
 
 #open json access token
 def fd_readtoken(fd_token):
@@ -487,15 +1139,34 @@ def fd_readtoken(fd_token):
         
     return json_obj["access_token"]
 
+#return a Mastodon client for an instance, reusing its HTTP session
+#clients are kept for the whole process, and recreated if the token file changes
+#fd_baseurl: instance URL (string)
+#fd_token: access token file name (string)
+def fd_client(fd_baseurl,fd_token):
+    try:
+        mtime = os.stat(fd_token).st_mtime_ns
+    except OSError as err:
+        print("ERROR:",err,'\n')
+        sys.exit(1)
+
+    return _fd_client(fd_baseurl,fd_token,mtime)
+
+@functools.lru_cache(maxsize=None)
+def _fd_client(fd_baseurl,fd_token,mtime):
+    from mastodon import Mastodon
+    return Mastodon(api_base_url=fd_baseurl,access_token=fd_readtoken(fd_token))
+
 #post a string to fediverse
 #fd_baseurl: instance URL (string)
 #fd_token: access token file name (string)
 #fd_vis: Mastodon.py visibility setting (string)
 #fd_string: the string to post
 def fd_poststring(fd_baseurl,fd_token,fd_vis,fd_string):
+    from mastodon import MastodonError
 
     try:
-        mastodon = Mastodon(api_base_url=str(fd_baseurl),access_token=fd_readtoken(str(fd_token)))
+        mastodon = fd_client(str(fd_baseurl),str(fd_token))
         mastodon.status_post(str(fd_string),visibility=str(fd_vis))
     except ValueError as err:
         print("ERROR:",err,'\n')
@@ -519,13 +1190,65 @@ def fd_verpart2():
 def fd_copyright():
     return str(fd_verline()+"\nCopyright (C) 2020, redneonglow\n\nIncorporates code from:\n\nfortune.py (original) - Copyright (C) 2008, Michael Goerz\nfortune.py (Python 3/UTF-8 fork) - Copyright (C) 2018, Volker Kettenbach\nDark Web Mystery Bot v3 - Copyright (C) 2019, redneonglow\n\nThis program is free software: you can redistribute it and/or modify\nit under the terms of the GNU General Public License as published by\nthe Free Software Foundation, version 3.\n\nThis program is distributed in the hope that it will be useful,\nbut WITHOUT ANY WARRANTY; without even the implied warranty of\nMERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the\nGNU General Public License for more details.\nYou should have received a copy of the GNU General Public License\nalong with this program.  If not, see <https://www.gnu.org/licenses/>.")
 
-def main():
+def write_fortune(fortune):
+    """ Write the fortune to standard output, encoded in one go for the 
+        underlying binary stream rather than through the text layer
     """
-    Main program.
+    sys.stdout.flush()
+    sys.stdout.buffer.write(fortune.encode(sys.stdout.encoding, 
+                                           sys.stdout.errors))
+    sys.stdout.buffer.flush()
+
+#  description and epilog of the --help output
+_HELP = """\
+Fortudon is a Fediverse bot designed for posting random BSD-style fortunes
+directly to Mastodon and Pleroma instances. It incorporates a fork of fortune.py
+and includes its own Fediverse bot features.
+
+fortune.py is an extended implementation of the classic BSD Unix fortune
+command. It combines the capabilities of the strfile command (which produces the
+fortune index file) and the fortune command (which displays a random fortune).
+It reads the traditional fortune program's text file format. For more
+information about the fortune files, and the accompanying fortune index files,
+see below."""
+
+_HELP_EPILOG = """\
+If <fortune_path> is omitted, fortune looks at the FORTUNE_PATH environment
+variable for the paths. Different paths in FORTUNE_PATH are separated by ':'.
+An individual item inside the fortune_path can be a direct fortune file, or a
+folder, in which case all fortune files inside the folder will be used. Any
+item may be preceded by a percentage, which is a number N between 0 and 99
+inclusive, followed by a %. If it is, there will be a N percent probability
+that a fortune will be picked from that file or directory. For items for which
+there is a percentage, the probability of a fortune being selected from any one
+of them is based on the relative number of fortunes it contains.
+
+The format of each fortune file is simple: All the fortunes appear in clear
+text, separated by a single line containing only a '%'. For example, the
+following is a fortune file containing two fortunes:
+
+    186,282 miles per second:
+
+    It isn't just a good idea, it's the law!
+    %
+    A bird in the hand makes it awfully hard to blow your nose.
+
+Before a fortune file can be used, you must generate an index file for it. This
+is a binary file that is used to select fortunes with more speed and
+efficiency.
+
+For more background information about the fortune utility look at
+http://en.wikipedia.org/wiki/Fortune_(Unix)"""
+
+def _build_parser():
     """
-    usage = 'Usage: %s [OPTIONS] fortune_path' % os.path.basename(sys.argv[0])
-    arg_parser = ArgumentParser(usage=usage,formatter_class=RawDescriptionHelpFormatter)
-    arg_parser.description = 'Fortudon is a Fediverse bot designed for posting random BSD-style fortunes\ndirectly to Mastodon and Pleroma instances. It incorporates a fork of fortune.py\nand includes its own Fediverse bot features.\n\nfortune.py is an extended implementation of the classic BSD Unix fortune\ncommand. It combines the capabilities of the strfile command (which produces the\nfortune index file) and the fortune command (which displays a random fortune).\nIt reads the traditional fortune program\'s text file format. For more\ninformation about the fortune files, and the accompanying fortune index files,\nsee below."'
+    Return the argument parser for the command line options.
+    """
+    from argparse import ArgumentParser,RawDescriptionHelpFormatter
+    usage = 'Usage: %s [OPTIONS] fortune_path' % _PROG
+    arg_parser = ArgumentParser(usage=usage, description=_HELP, 
+                                epilog=_HELP_EPILOG,
+                                formatter_class=RawDescriptionHelpFormatter)
     arg_parser.add_argument('-u', '--update', action='store_true', dest='update',
                           help='Update the index files, instead of printing a '
                                'fortune. You must run this before you will be '
@@ -555,6 +1278,11 @@ def main():
                           help="Consider all fortune files to be of equal " 
                                "size, making it equally likely for a "
                                "fortune to be chosen from any fortune file")
+    arg_parser.add_argument('--secure', action='store_true', dest='secure',
+                          help="Pick fortunes with random numbers from the "
+                               "operating system, which are suitable for "
+                               "cryptography, instead of with a faster "
+                               "pseudo-random generator")
     arg_parser.add_argument('-f', '--fortunefiles', action='store_true',
                           dest='list_fortunefiles',
                           help="Print out the list of files which would be " 
@@ -588,76 +1316,68 @@ def main():
     arg_parser.add_argument('-i', '--ignorecase', action='store_true', 
                           dest='ignorecase',
                           help="Ignore case for -m patterns.")
+    arg_parser.add_argument('-j', '--jobs', action='store', type=int,
+                          dest='jobs',
+                          default=max(1, (os.cpu_count() or 1) // 2),
+                          help="Number of worker processes used to scan "
+                               "fortune files for -m patterns (the default "
+                               "is %(default)s)")
     arg_parser.add_argument('-s', '--short', action='store_true', 
                           dest='use_short',
                           help="Show only short fortunes. See -n on how " 
                                "''short'' is defined in this sense.")
     arg_parser.add_argument('-n', action='store', dest='max_shortlength',
+                          type=int, default=DEFAULT_LENGTH,
                           help="Set the longest fortune length (in " 
                                "characters) considered to be ''short'' " 
                                "(the default is %s)" % DEFAULT_LENGTH)
+    arg_parser.add_argument('--daemon', action='store_true', dest='daemon',
+                          help="Keep running, and serve fortunes to other "
+                               "invocations of %s over a Unix socket in "
+                               "$XDG_RUNTIME_DIR, so that they don't have to "
+                               "load the index files themselves. They fall "
+                               "back to picking fortunes themselves if the "
+                               "daemon isn't running." % _PROG)
     arg_parser.add_argument('-c','--copyright',action='store_true',help='Display Fortudon copyright and license info')
     arg_parser.add_argument('-v','--version',action='store_true',help='Display version info for Fortudon')
     arg_parser.add_argument('-p','--postfortune',help='Post fortune to Fediverse site SERVER using token file TOKEN and visibility value VISIBILITY. Otherwise stdout is used. Use with caution!',type=str,nargs=3,metavar=("SERVER","TOKEN","VISIBILITY"))
 
-    arg_parser.epilog = 'If <fortune_path> is omitted, fortune looks at ' \
-        'the FORTUNE_PATH environment variable for the paths. Different ' \
-        'paths in FORTUNE_PATH are separated by \':\'.\n' \
-        'An individual item inside the fortune_path can be a direct fortune' \
-        'file, or a folder, in which case all fortune files inside the ' \
-        'folder will be used. Any item may be preceded by a percentage, '\
-        'which is a number N between 0  and 99 inclusive, followed by a %. ' \
-        'If it is, there will be a N percent probability that a fortune ' \
-         'will be picked from that file or directory. For items for which ' \
-         'there is a percentage, the probability of a fortune being selected ' \
-         'from any one of them is based on the relative number of fortunes ' \
-         'it contains.\n\n' \
-         'The format of each fortune file is simple: All the fortunes appear ' \
-         'in clear text, separated by a single line containing only a ' \
-         '\'%\'. For example, the following is a fortune file containing two ' \
-         'fortunes:\n\n' \
-         '    186,282 miles per second:\n\n' \
-         '    It isn\'t just a good idea, it\'s the law!\n' \
-         '    %\n' \
-         '    A bird in the hand makes it awfully hard to blow your nose.\n\n' \
-         'Before a fortune file can be used, you must generate an index ' \
-         'file for it. This is a binary file that is used to select ' \
-         'fortunes with more speed and efficiency.\n\n' \
-         'For more background information about the fortune utility ' \
-         'look at http://en.wikipedia.org/wiki/Fortune_(Unix)'
-         
-    options, args = arg_parser.parse_known_args(sys.argv)
+    return arg_parser
+
+def main():
+    """
+    Main program.
+    """
+    # Printing a fortune from the FORTUNE_PATH paths with no options is the
+    # most common use, and doesn't need the argument parser at all.
+    if len(sys.argv) == 1 and _DEFAULT_PATHS is not None:
+        try:
+            fortout = fortune_from_daemon(_DEFAULT_PATHS, offensive=False)
+            if fortout is None:
+                fortout = get_random_fortune(_DEFAULT_PATHS, offensive=False)
+            write_fortune(fortout)
+        except ValueError as msg:
+            print(msg, file=sys.stderr)
+            sys.exit(2)
+        sys.exit(0)
+
+    options, args = _build_parser().parse_known_args(sys.argv)
 
     if len(args) >= 2:
         fortunepaths = args[1:]
-    elif not (options.version or options.copyright):    
-        try:
-            fortunepaths = os.environ['FORTUNE_PATH'].split(':')
-        except KeyError:
+    elif not (options.version or options.copyright or options.daemon):
+        fortunepaths = _DEFAULT_PATHS
+        if fortunepaths is None:
             print ("Missing fortune files", file=sys.stderr)
-            print ("Try %s --help" % os.path.basename(sys.argv[0]), file=sys.stderr)
+            print ("Try %s --help" % _PROG, file=sys.stderr)
             sys.exit(2)
 
-    if options.use_all:
-        offensive = None
-    elif options.offensive:
-        offensive = True
-    else:
-        offensive = False
-
-    if options.use_short:
-        minlength = 0
-        maxlength = DEFAULT_LENGTH 
-        if not options.max_shortlength is None:
-            maxlength = int(options.max_shortlength)
-    elif options.use_long:
-        minlength = DEFAULT_LENGTH 
-        if not options.max_shortlength is None:
-            minlength = int(options.max_shortlength)
-        maxlength = None
-    else:
-        minlength = 0
-        maxlength = None
+    # -a overrides -o, and -s overrides -l
+    offensive = _OFFENSIVE_OPTIONS[options.use_all << 1 | options.offensive]
+    shortlength = options.max_shortlength
+    minlength, maxlength = ((0, None), (shortlength, None), 
+                            (0, shortlength), (0, shortlength)
+                           )[options.use_short << 1 | options.use_long]
 
     try:
         # Update Mode
@@ -671,6 +1391,14 @@ def main():
             if options.copyright:
                 print('\n' + fd_copyright() + '\n')
 
+        # Daemon Mode
+        elif options.daemon:
+            socket_path = daemon_socket_path()
+            if socket_path is None:
+                raise ValueError("XDG_RUNTIME_DIR isn't set, there is "
+                                 "nowhere to put the socket")
+            serve_fortunes(socket_path)
+
         # Listing Fortune Files Mode
         elif options.list_fortunefiles:
             percentages, fortune_files = fortune_files_from_paths(fortunepaths,
@@ -682,21 +1410,24 @@ def main():
         elif not options.pattern is None:
             filter_fortunes(fortunepaths, options.pattern, 
                             ignorecase=options.ignorecase, 
-                            offensive=offensive)
+                            offensive=offensive, min_length=minlength,
+                            max_length=maxlength, jobs=options.jobs)
 
         # Printing Fortunes or Posting Fortunes Mode
         else:
-            fortout = get_random_fortune(
-                fortunepaths, 
-                offensive=offensive,
-                weighted=(not options.equal_size),
-                min_length=minlength,
-                max_length=maxlength)
+            fortune_options = dict(offensive=offensive,
+                                   weighted=(not options.equal_size),
+                                   secure=options.secure,
+                                   min_length=minlength,
+                                   max_length=maxlength)
+            fortout = fortune_from_daemon(fortunepaths, **fortune_options)
+            if fortout is None:
+                fortout = get_random_fortune(fortunepaths, **fortune_options)
 
             if options.postfortune:
                 fd_poststring(options.postfortune[0],options.postfortune[1],options.postfortune[2],fortout)
             else:
-                sys.stdout.write(fortout)
+                write_fortune(fortout)
 
     except ValueError as msg:
         print(msg, file=sys.stderr)